@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 
-from ase.io.espresso import read_espresso_out
-from copy import copy
+from ase.io.espresso import (read_espresso_out, _PW_START, _PW_POS, _PW_TOTEN, _PW_FORCE, _PW_STRESS,
+                              _PW_MAGMOM, _PW_END, _PW_BANDSTRUCTURE)
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
 from pathlib import Path
 from raw_parser import parse
+from typing import Iterable, List, Optional
 
 import ase.db
 import argparse
+import json
+import mmap
 import numpy as np
-import pandas as pd
+import os
 import re
+import tempfile
+
+_BORDER_RE = re.compile(r'\+[+-]+')
+_NL_TRANS = str.maketrans('', '', '\n')
+_CALCFOLD_RE = re.compile(r'CalcFold(\d+)_(\d+)$')
+_RESULTS_RE = re.compile(r'results(\d+)$')
+
+# A structure is started by one of _PW_CONFIG lines and is returned by read_espresso_out
+# (with results_required=True) only if any of _PW_RESULTS lines follows it before the next structure
+_PW_CONFIG = (_PW_START, _PW_POS)
+_PW_RESULTS = (_PW_TOTEN, _PW_FORCE, _PW_STRESS, _PW_MAGMOM, _PW_END, _PW_BANDSTRUCTURE)
+
 
 def getResFolderName(path: Path = Path.cwd()) -> Path:
     '''
@@ -17,36 +35,151 @@ def getResFolderName(path: Path = Path.cwd()) -> Path:
     :return: path of results folder
     '''
 
-    folderNum = 1
-    tmpFold = path / f'results{folderNum}'
-    resFolder = tmpFold
+    folderNum = 0
+    resFolder = path / 'results1'
 
-    while tmpFold.is_dir():
-        resFolder = tmpFold
-        folderNum += 1
-        tmpFold = path / f'results{folderNum}'
+    for entry in os.scandir(path):
+        m = _RESULTS_RE.match(entry.name)
+        if m and int(m.group(1)) > folderNum and entry.is_dir():
+            folderNum = int(m.group(1))
+            resFolder = Path(entry.path)
     return resFolder
 
 
+def get_calcfolds(path: Path) -> dict:
+    '''
+    :param path: path to the folder where USPEX has been started
+    :return: {ID: {stage: path of CalcFold{ID}_{stage}}} built from a single directory listing
+    '''
+    calcfolds = {}
+    for entry in os.scandir(path):
+        m = _CALCFOLD_RE.match(entry.name)
+        if m and entry.is_dir():
+            calcfolds.setdefault(int(m.group(1)), {})[int(m.group(2))] = Path(entry.path)
+    return calcfolds
+
+
 def parse_ascii_table(ascii_table):
-    table_re_list = re.split(r'\+[+-]+', ascii_table)
-    table_list = [l.strip().replace('\n', '') for l in table_re_list if l.strip()]
+    import pandas as pd  # only needed here, so pandas is not imported on the main path
+
+    table_list = []
+    for block in _BORDER_RE.split(ascii_table):
+        block = block.strip()
+        if block:
+            table_list.append(block.translate(_NL_TRANS))
     columns = [ch.strip() for ch in table_list[0].split('|') if ch.strip()]
-    table = pd.DataFrame(columns=columns)
+    rows = []
     for row in table_list[1:]:
-        for lines in [line for line in row.split('||')]:
-            line_part = [i.strip() for i in lines.split('|') if i]
-            table = pd.concat([table, pd.DataFrame([line_part], columns=columns)], ignore_index=True)
-    return table
+        for line in row.split('||'):
+            rows.append([i.strip() for i in line.split('|') if i])
+    return pd.DataFrame(rows, columns=columns)
+
+
+def read_ids(datafile: Path) -> List[int]:
+    '''
+    Reads only the ID column of the ASCII table, line by line from the memory-mapped file
+    :param datafile: path to extended_convex_hull or goodStructures file of USPEX
+    :return: IDs of the structures in the table
+    '''
+    ids = []
+    id_column = 0
+    if datafile.stat().st_size == 0:  # empty file cannot be mapped
+        return ids
+    with open(datafile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b''):
+            if not line.startswith(b'|'):
+                continue
+            cells = line.strip().strip(b'|').split(b'|')
+            try:
+                ids.append(int(cells[id_column]))
+            except (ValueError, IndexError):
+                cells = [c.strip() for c in cells]
+                if b'ID' in cells:  # header of the table
+                    id_column = cells.index(b'ID')
+    return ids
+
+
+# version of the read_params cache format, has to be bumped whenever parse or _process change their output
+PARAMS_CACHE_VERSION = 2
+
+
+def _params_cache_file(params_file: Path) -> Path:
+    return params_file.with_name(f'.{params_file.name}.cache.json')
+
+
+def _to_json(value):
+    # JSON has no tuples, they are stored as {"__tuple__": [...]} to come back as tuples
+    if isinstance(value, tuple):
+        return {'__tuple__': [_to_json(v) for v in value]}
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    return value
+
+
+def _from_json(obj: dict):
+    return tuple(obj['__tuple__']) if obj.keys() == {'__tuple__'} else obj
+
+
+def _load_params_cache(params_file: Path, stat_key: list):
+    '''
+    :return: cached result of read_params or None if the cache is missing, outdated or unreadable
+    '''
+    try:
+        with open(_params_cache_file(params_file), 'rt') as f:
+            cached = json.load(f, object_hook=_from_json)
+    except Exception:  # the cache is only an optimization, whatever is wrong with it counts as a miss
+        return None
+    if not (isinstance(cached, dict) and cached.get('key') == stat_key and isinstance(cached.get('params'), dict)):
+        return None
+    return cached['params']
+
+
+def _dump_params_cache(params_file: Path, stat_key: list, params: dict):
+    cache_file = _params_cache_file(params_file)
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=cache_file.parent, prefix=cache_file.name)
+    except OSError:  # e.g. read-only calculation folder – just skip caching
+        return
+    try:
+        with os.fdopen(fd, 'wt') as f:
+            json.dump({'key': stat_key, 'params': _to_json(params)}, f)
+        os.replace(tmp_name, cache_file)
+    except OSError:  # e.g. no space left – the result is just not cached
+        pass
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
 
 def read_params(params_file: Path):
     assert params_file.exists()
+    stat = params_file.stat()
+    stat_key = [PARAMS_CACHE_VERSION, stat.st_mtime_ns, stat.st_size]
+    params = _load_params_cache(params_file, stat_key)
+    if params is not None:
+        return params
+
     with open(params_file, 'rt') as f:
         sections = f.read().split('#define ')
 
-    def _process(input, definitions: dict):
+    definitions = {}
+    for section in sections[1:]:
+        name, definition = section.split('\n', 1)
+        name = name.strip()
+        definitions[name] = parse(definition)
+        definitions[name]['name'] = name
+
+    # every #define is expanded only once, references to it get a deep copy of the expansion
+    expanded = {}
+
+    def _process(input, resolving: tuple = ()):
         if isinstance(input, str) and input in definitions:
-            input = copy(definitions[input])
+            if input not in expanded:
+                assert input not in resolving, f'Cyclic #define {input} in {params_file}'
+                expanded[input] = _process(definitions[input], resolving + (input,))
+            return deepcopy(expanded[input])
         if isinstance(input, list):
             items = enumerate(input)
         elif isinstance(input, dict):
@@ -55,28 +188,66 @@ def read_params(params_file: Path):
             items = []
         for i, element in items:
             if i != 'name':
-                input[i] = _process(element, definitions)
+                input[i] = _process(element, resolving)
         return input
 
-    definitions = {}
-    for section in sections[1:]:
-        name, definition = section.split('\n', 1)
-        name = name.strip()
-        definitions[name] = parse(definition)
-        definitions[name]['name'] = name
-    return _process(parse(sections[0]), definitions)
+    params = _process(parse(sections[0]))
+    _dump_params_cache(params_file, stat_key, params)
+    return params
+
 
+def _iter_structures(output_file: Path, index: slice = slice(None)):
+    with open(output_file, 'r', buffering=2**20) as fp:
+        yield from read_espresso_out(fp, index=index)
 
-def read_structures(calcfold: Path):
+
+def read_structures(calcfold: Path, keep: Optional[Iterable[int]] = None):
+    '''
+    :param calcfold: path to the CalcFold* folder with QE output
+    :param keep: non-negative indices of structures to keep, all structures are kept if None
+    :return: list of the kept structures in the order of optimization steps
+    '''
     assert calcfold.exists(), f'Please, check whether calcfold {calcfold} exists.'
     output_file = calcfold/'output'
-    structures = []
     if not output_file.exists():
         return
-    with open(output_file, 'r') as fp:
-        structures.extend(list(read_espresso_out(fp, index=slice(None))))
+    if keep is None:
+        return list(_iter_structures(output_file))
+    keep = sorted(set(keep))
+    # ASE builds only the structures of the slice, so the widest step covering all kept indices is used
+    step = int(np.gcd.reduce(np.diff(keep))) or 1
+    index = slice(keep[0], keep[-1]+1, step)
+    keep = set(keep)
+    frames = zip(range(index.start, index.stop, index.step), _iter_structures(output_file, index))
+    structures = [s for i, s in frames if i in keep]
+    # catches only read_espresso_out returning fewer structures than count_structures, not more of them
+    assert len(structures) == len(keep), \
+        f'Only {len(structures)} of {len(keep)} structures with indices {sorted(keep)} have been read from ' \
+        f'{output_file}. Seems like count_structures does not match read_espresso_out of this ASE version'
     return structures
 
+
+def count_structures(calcfold: Path) -> int:
+    '''
+    Counts structures the same way as read_espresso_out does, but by plain line scanning
+    :param calcfold: path to the CalcFold* folder with QE output
+    :return: number of structures in QE output
+    '''
+    output_file = calcfold/'output'
+    if not output_file.exists():
+        return 0
+    num_structures = 0
+    has_config = False
+    with open(output_file, 'r', buffering=2**20) as fp:
+        for line in fp:
+            if any(marker in line for marker in _PW_CONFIG):
+                has_config = True
+            elif has_config and any(marker in line for marker in _PW_RESULTS):
+                num_structures += 1
+                has_config = False
+    return num_structures
+
+
 def get_metadata(params_path: Path) -> dict:
     assert params_path.exists()
     params = read_params(params_path)
@@ -107,6 +278,45 @@ def get_metadata(params_path: Path) -> dict:
     metadata.update({'opt_stages': opt_stages})
     return metadata
 
+
+def read_stage(calcfold: Path, uid: int, mode: str, seed: np.random.SeedSequence) -> list:
+    '''
+    Reads structures of one optimization stage that have to be written to the DB.
+    Runs in worker processes, so it does not touch the DB itself.
+    :param calcfold: path to the CalcFold* folder with QE output
+    :param uid: ID of the structure in USPEX
+    :param mode: mode of reading optimization steps, one of MODES
+    :param seed: seed for the random choice of optimization steps in 'selected' mode
+    :return: list of (structure, key_value_pairs) pairs
+    '''
+    if mode == 'all':
+        structures = read_structures(calcfold)
+    else:
+        # only needed structures are parsed, the last one is used to check the cell
+        num_structures = count_structures(calcfold)
+        assert num_structures, f'Please, check whether {calcfold} contains finished QE calculation.'
+        selected_ids = []
+        if mode == 'selected':
+            if num_structures-2 < num_selected_steps:  # number of opt steps are less than threshold
+                selected_ids = list(range(1, num_structures-1))
+            else:
+                rng = np.random.default_rng(seed)
+                selected_ids = np.sort(rng.choice(num_structures-2, size=num_selected_steps, replace=False) + 1).tolist()
+        structures = read_structures(calcfold, keep=[0, *selected_ids, num_structures-1])
+
+    # the cell is variable if any of its components changes along the read optimization steps
+    cells = np.stack([np.asarray(s.cell) for s in structures])
+    var_cell = bool(np.ptp(cells.reshape(len(cells), -1), axis=0).max() > 1e-8)
+    base_kvp = {'uid': uid, 'var_cell': var_cell}
+    rows = [(structures[0], {**base_kvp, 'opt_step': 'generated'})]
+    if mode == 'selected':
+        rows += [(s, {**base_kvp, 'opt_step': i+1}) for i, s in zip(selected_ids, structures[1:-1])]
+    elif mode == 'all':
+        rows += [(s, {**base_kvp, 'opt_step': i+1}) for i, s in enumerate(structures[1:-1])]
+    if mode != 'generated':
+        rows.append((structures[-1], {**base_kvp, 'opt_step': 'optimized'}))
+    return rows
+
 # ==========================================
 
 # number of intermediate optimization steps that will be written to DB
@@ -168,49 +378,63 @@ if __name__ == '__main__':
     db.metadata = metadata
     print('METADATA from USPEX has been read and appended to the database.')
 
-    with open(datafile) as fp:
-        x = fp.read()
-        data = parse_ascii_table(x)
+    ids = read_ids(datafile)
 
     print('----------------------------------')
-    print(f'TOTAL: {len(data)} points on the extended CH\n')
+    print(f'TOTAL: {len(ids)} points on the extended CH\n')
+
+    calcfolds = get_calcfolds(uspex_fold)
 
-    # Reading structures
-    for j, id in data['ID'].items():
-        folders = list(uspex_fold.glob(f'CalcFold{id}_*'))
+    # Collecting (number, ID, CalcFold) of every stage that has to be read
+    items = []
+    for j, uid in enumerate(ids):
+        folders = calcfolds.get(uid, {})
         assert len(folders)
         for stage_id, _ in enumerate(metadata['opt_stages']):
-            f = uspex_fold/f'CalcFold{id}_{stage_id+1}'
-
             # Last stage of surface calculation is just substrate – skipping this step
             if is_surface and stage_id+1 == num_stages:
                 continue
 
-            structures = read_structures(f)
-            var_cell = np.allclose(structures[0].get_cell(), structures[-1].get_cell())
-            spec_data = {'uid': int(id), 'opt_step': 'generated', 'var_cell': var_cell}
-            db.write(structures[0], key_value_pairs=spec_data)
-            if mode == 'generated':
-                print(f'{j+1}\t {f.name} \thas been added only generated structure')
-                continue
-            elif mode == 'selected':
-                if len(structures[1:-1]) < num_selected_steps:  # number of opt steps are less than threshold
-                    selected_ids = range(1, len(structures)-1)
-                else:
-                    selected_ids = sorted(np.random.choice(range(1,len(structures)-1), size=num_selected_steps, replace=False))
-
-                for i in selected_ids:
-                    spec_data.update({'opt_step': i+1})
-                    db.write(structures[i], key_value_pairs=spec_data)
-                spec_data.update({'opt_step': 'optimized'})
-                db.write(structures[-1], key_value_pairs=spec_data)
-                print(f'{j+1}\t {f.name} \thave been added initial, final and some selected structures')
-            elif mode == 'all':
-                for i, s in enumerate(structures[1:-1]):
-                    spec_data.update({'opt_step': i+1})
-                    db.write(s, key_value_pairs=spec_data)
-                spec_data.update({'opt_step': 'optimized'})
-                db.write(structures[-1], key_value_pairs=spec_data)
-                print(f'{j+1}\t {f.name} \thas been added all {len(structures)} structures')
+            assert stage_id+1 in folders, f'Please, check whether calcfold CalcFold{uid}_{stage_id+1} exists.'
+            items.append((j, uid, folders[stage_id+1]))
+    # independent random streams for the choice of optimization steps in every worker
+    seeds = np.random.SeedSequence().spawn(len(items))
+
+    # QE outputs are parsed in parallel and written by this process in the order of IDs.
+    # Only 2 stages per worker are submitted ahead, so parsed structures do not pile up waiting for the writer
+    # CPUs actually available to the process (cgroups, batch systems), not all CPUs of the node
+    if hasattr(os, 'sched_getaffinity'):
+        max_workers = len(os.sched_getaffinity(0))
+    else:
+        max_workers = os.cpu_count() or 1
+    work = iter(zip(items, seeds))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+
+        def submit_next():
+            item = next(work, None)
+            if item is not None:
+                (j, uid, f), seed = item
+                pending.append((j, f, pool.submit(read_stage, f, uid, mode, seed)))
+
+        for _ in range(2*max_workers):
+            submit_next()
+        while pending:
+            # All structures of the same ID are written within a single DB transaction
+            current = pending[0][0]
+            with db:
+                while pending and pending[0][0] == current:
+                    j, f, future = pending.popleft()
+                    rows = future.result()
+                    submit_next()
+
+                    for s, kvp in rows:
+                        db.write(s, key_value_pairs=kvp)
+                    if mode == 'generated':
+                        print(f'{j+1}\t {f.name} \thas been added only generated structure')
+                    elif mode == 'selected':
+                        print(f'{j+1}\t {f.name} \thave been added initial, final and some selected structures')
+                    elif mode == 'all':
+                        print(f'{j+1}\t {f.name} \thas been added all {len(rows)} structures')
 
     print('-------------- FINISH --------------')
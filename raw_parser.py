@@ -1,134 +1,290 @@
 """
-relaxedjson (https://github.com/simon-engledew/relaxedjson) is a library
-for parsing JSON that is missing quotes around its keys.
-Uses the parser-combinator library Parsec (https://github.com/sighingnow/parsec.py)
-To install from pypi::
-    pip install relaxedjson
-To install as an egg-link in development mode::
-    python setup.py develop -N
+Parser of the relaxed JSON used in USPEX input files: keys and string values
+may be unquoted, commas between elements are optional, ``( )`` denotes a tuple
+and ``/* */`` comments may appear between any tokens.
+
+Initially based on relaxedjson (https://github.com/simon-engledew/relaxedjson),
+now a hand-written recursive-descent parser over a tokenizer of the UTF-8 bytes.
+Texts are tokenized with a precompiled regex, large ones (see _NUMBA_MIN_SIZE)
+with an equivalent scanner compiled by numba if it is installed.
 """
 
+import numpy as np
 import re
-from parsec import (
-    sepBy,
-    regex,
-    string,
-    generate,
-    many,
-    endBy
-)
-
-whitespace = regex(r'[^\S\r\n]*', re.MULTILINE)
-vertwhitespace = regex(r'\s*', re.MULTILINE)
-
-lexeme = lambda p: p << whitespace
-openlexeme = lambda p: p << vertwhitespace
-closelexeme = lambda p: vertwhitespace >> p << whitespace
-
-comment = string('/*') >> regex(r'(?:[^*]|\*(?!\/))+', re.MULTILINE) << string('*/')
-comment = openlexeme(comment)
-
-lbrace = openlexeme(string('{'))
-rbrace = closelexeme(string('}'))
-lbrack = openlexeme(string('['))
-rbrack = closelexeme(string(']'))
-lbround = openlexeme(string('('))
-rbround = closelexeme(string(')'))
-colon = lexeme(string(':'))
-separator = openlexeme(string(',')) | vertwhitespace
-true = lexeme(string('True')).result(True)
-false = lexeme(string('False')).result(False)
-null = lexeme(string('None')).result(None)
-quote = string('"') | string("'")
-literal = lexeme(regex(r'(?!True)(?!False)(?!None)[a-zA-Z][-_a-zA-Z0-9.]*'))
-
-def number_float():
-    return lexeme(
-        regex(r'-?(0|[1-9][0-9]*)([.][0-9]+)([eE][+-]?[0-9]+)?')
-    ).parsecmap(float)
-
-def number_int():
-    return lexeme(
-        regex(r'-?(0|[1-9][0-9]*)')
-    ).parsecmap(int)
-
-def to_chr(value):
-    return chr(int(value[1:], 16))
-
-def charseq(end_quote):
-    def string_part():
-        return regex(r'[^{}\\]+'.format(end_quote))
-
-    def string_esc():
-        return string('\\') >> (
-            string('\\')
-            | string('/')
-            | string('b').result('\b')
-            | string('f').result('\f')
-            | string('n').result('\n')
-            | string('r').result('\r')
-            | string('t').result('\t')
-            | regex(r'u[0-9a-fA-F]{4}').parsecmap(to_chr)
-            | string(end_quote)
-        )
-    return string_part() | string_esc()
-
-class StopGenerator(StopIteration):
-    def __init__(self, value):
-        self.value = value
-
-@lexeme
-@generate
-def quoted():
-    end_quote = yield quote
-    body = yield many(charseq(end_quote))
-    yield string(end_quote)
-    raise StopGenerator(''.join(body))
-
-@generate
-def array():
-    yield lbrack << many(comment)
-    elements = yield sepBy(value, separator)
-    yield rbrack << many(comment)
-    raise StopGenerator(elements)
-
-@generate
-def tuple_object():
-    yield lbround << many(comment)
-    elements = yield sepBy(value, separator)
-    yield rbround << many(comment)
-    raise StopGenerator(tuple(elements))
-
-
-@generate
-def object_pair():
-    yield many(comment)
-    key = yield quoted | literal
-    yield many(comment) << colon << many(comment)
-    val = yield value
-    yield many(comment)
-    raise StopGenerator((key, val))
-
-
-@generate
-def json_object():
-    yield lbrace << many(comment)
-    pairs = yield sepBy(object_pair, separator)
-    yield many(comment) << rbrace
-    raise StopGenerator(dict(pairs))
-
-value = literal | quoted | number_float() | number_int() | json_object | array | tuple_object | true | false | null
-value = many(comment) >> value << many(comment)
-
-parser = vertwhitespace >> (json_object | array | tuple_object) << vertwhitespace
+
+
+class ParseError(ValueError):
+    pass
+
+
+(EOF, LBRACE, RBRACE, LBRACK, RBRACK, LPAREN, RPAREN, COLON, COMMA,
+ STRING, FLOAT, INT, IDENT, CONST, ERROR) = range(15)
+
+_KIND_NAMES = ('EOF', 'LBRACE', 'RBRACE', 'LBRACK', 'RBRACK', 'LPAREN', 'RPAREN', 'COLON', 'COMMA',
+               'STRING', 'FLOAT', 'INT', 'IDENT', 'CONST', 'ERROR')
+
+_TOKEN_RE = re.compile(rb'''
+    (?P<WS>\s+)
+  | (?P<COMMENT>/\*.*?\*/)
+  | (?P<STRING>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<FLOAT>-?(?:0|[1-9][0-9]*)\.[0-9]+(?:[eE][+-]?[0-9]+)?)
+  | (?P<INT>-?(?:0|[1-9][0-9]*))
+  | (?P<IDENT>[a-zA-Z][-_a-zA-Z0-9.]*)
+  | (?P<LBRACE>\{)
+  | (?P<RBRACE>\})
+  | (?P<LBRACK>\[)
+  | (?P<RBRACK>\])
+  | (?P<LPAREN>\()
+  | (?P<RPAREN>\))
+  | (?P<COLON>:)
+  | (?P<COMMA>,)
+  | (?P<ERROR>.)
+''', re.VERBOSE | re.DOTALL)
+
+_ESCAPE_RE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)', re.DOTALL)
+_ESCAPES = {'\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', '"': '"', "'": "'"}
+
+_CONSTANTS = {'True': True, 'False': False, 'None': None}
+
+
+def _scan_re(data):
+    kinds, starts, ends = [], [], []
+    for m in _TOKEN_RE.finditer(data):
+        kind = m.lastgroup
+        if kind == 'WS' or kind == 'COMMENT':
+            continue
+        kinds.append(_KIND_NAMES.index(kind))
+        starts.append(m.start())
+        ends.append(m.end())
+        if kind == 'ERROR':
+            break
+    return kinds, starts, ends
+
+
+def _scan_numba(buf):
+    n = len(buf)
+    kinds = np.empty(n, np.int32)
+    starts = np.empty(n, np.int32)
+    ends = np.empty(n, np.int32)
+    count = 0
+    i = 0
+    while i < n:
+        c = buf[i]
+        # whitespaces: ' ', \t, \n, \v, \f, \r
+        if c == 32 or 9 <= c <= 13:
+            i += 1
+            continue
+        kind = ERROR
+        j = i + 1
+        if c == 47 and j < n and buf[j] == 42:  # /* comment */
+            j += 1
+            while j + 1 < n and not (buf[j] == 42 and buf[j + 1] == 47):
+                j += 1
+            if j + 1 < n:
+                i = j + 2
+                continue
+            j = i + 1
+        elif c == 34 or c == 39:  # quoted string
+            while j < n and buf[j] != c:
+                j += 2 if buf[j] == 92 else 1
+            if j < n:
+                kind = STRING
+                j += 1
+            else:
+                j = i + 1
+        elif c == 45 or 48 <= c <= 57:  # number
+            k = i + 1 if c == 45 else i
+            if k < n and 48 <= buf[k] <= 57:
+                kind = INT
+                k += 1
+                if buf[k - 1] != 48:
+                    while k < n and 48 <= buf[k] <= 57:
+                        k += 1
+                if k + 1 < n and buf[k] == 46 and 48 <= buf[k + 1] <= 57:
+                    kind = FLOAT
+                    k += 2
+                    while k < n and 48 <= buf[k] <= 57:
+                        k += 1
+                    if k < n and (buf[k] == 101 or buf[k] == 69):
+                        e = k + 1
+                        if e < n and (buf[e] == 43 or buf[e] == 45):
+                            e += 1
+                        if e < n and 48 <= buf[e] <= 57:
+                            while e < n and 48 <= buf[e] <= 57:
+                                e += 1
+                            k = e
+                j = k
+        elif 65 <= c <= 90 or 97 <= c <= 122:  # identifier [a-zA-Z][-_a-zA-Z0-9.]*
+            kind = IDENT
+            while j < n:
+                d = buf[j]
+                if not (65 <= d <= 90 or 97 <= d <= 122 or 48 <= d <= 57 or d == 45 or d == 95 or d == 46):
+                    break
+                j += 1
+        elif c == 123:
+            kind = LBRACE
+        elif c == 125:
+            kind = RBRACE
+        elif c == 91:
+            kind = LBRACK
+        elif c == 93:
+            kind = RBRACK
+        elif c == 40:
+            kind = LPAREN
+        elif c == 41:
+            kind = RPAREN
+        elif c == 58:
+            kind = COLON
+        elif c == 44:
+            kind = COMMA
+        kinds[count] = kind
+        starts[count] = i
+        ends[count] = j
+        count += 1
+        if kind == ERROR:
+            break
+        i = j
+    return kinds[:count], starts[:count], ends[:count]
+
+
+def _scan_buf(data):
+    kinds, starts, ends = _scan_numba_jit(np.frombuffer(data, dtype=np.uint8))
+    return kinds.tolist(), starts.tolist(), ends.tolist()
+
+
+# numba is imported and the tokenizer compiled only for inputs of at least this size, on the usual
+# input.uspex of a few KB the regex tokenizer is orders of magnitude faster than numba's start-up
+_NUMBA_MIN_SIZE = 256 * 2**10
+
+_scan_numba_jit = None
+
+
+def _get_scan(size):
+    global _scan_numba_jit
+    if size < _NUMBA_MIN_SIZE:
+        return _scan_re
+    if _scan_numba_jit is None:
+        try:
+            from numba import njit
+        except ImportError:
+            return _scan_re
+        _scan_numba_jit = njit(cache=True)(_scan_numba)
+    return _scan_buf
+
+
+def _error(data, pos, message):
+    line = data.count(b'\n', 0, pos) + 1
+    column = pos - data.rfind(b'\n', 0, pos)
+    return ParseError(f'{message} at line {line}, column {column}')
+
+
+def _unescape(data, start, body):
+    def _replace(m):
+        esc = m.group(1)
+        if esc[0] == 'u' and len(esc) == 5:
+            return chr(int(esc[1:], 16))
+        if esc not in _ESCAPES:
+            raise _error(data, start + len(body[:m.start()].encode()), f'Invalid escape sequence \\{esc}')
+        return _ESCAPES[esc]
+    return _ESCAPE_RE.sub(_replace, body) if '\\' in body else body
+
+
+def _tokenize(data):
+    """
+    Split UTF-8 encoded text into a list of (kind, value, position) tokens terminated by an EOF token.
+    Whitespaces and comments are skipped.
+    """
+    kinds, starts, ends = _get_scan(len(data))(data)
+
+    tokens = []
+    for kind, start, end in zip(kinds, starts, ends):
+        if kind == STRING:
+            value = _unescape(data, start + 1, data[start + 1:end - 1].decode())
+        elif kind == FLOAT:
+            value = float(data[start:end])
+        elif kind == INT:
+            value = int(data[start:end])
+        elif kind == IDENT:
+            value = data[start:end].decode()
+            if value in _CONSTANTS:
+                kind, value = CONST, _CONSTANTS[value]
+        elif kind == ERROR:
+            raise _error(data, start, f'Unexpected character {data[start:end].decode(errors="replace")!r}')
+        else:
+            value = None
+        tokens.append((kind, value, start))
+    tokens.append((EOF, None, len(data)))
+    return tokens
+
+
+def _expect(data, tokens, pos, kind):
+    if tokens[pos][0] != kind:
+        raise _error(data, tokens[pos][2], f'Expected {_KIND_NAMES[kind]}, got {_KIND_NAMES[tokens[pos][0]]}')
+    return pos + 1
+
+
+def _parse_elements(data, tokens, pos, closing):
+    elements = []
+    while tokens[pos][0] != closing:
+        value, pos = parse_value(data, tokens, pos)
+        elements.append(value)
+        if tokens[pos][0] == COMMA:
+            pos += 1
+    return elements, pos + 1
+
+
+def parse_array(data, tokens, pos):
+    pos = _expect(data, tokens, pos, LBRACK)
+    return _parse_elements(data, tokens, pos, RBRACK)
+
+
+def parse_tuple(data, tokens, pos):
+    pos = _expect(data, tokens, pos, LPAREN)
+    elements, pos = _parse_elements(data, tokens, pos, RPAREN)
+    return tuple(elements), pos
+
+
+def parse_object(data, tokens, pos):
+    pos = _expect(data, tokens, pos, LBRACE)
+    result = {}
+    while tokens[pos][0] != RBRACE:
+        kind, key, start = tokens[pos]
+        if kind != IDENT and kind != STRING:
+            raise _error(data, start, f'Expected key, got {_KIND_NAMES[kind]}')
+        pos = _expect(data, tokens, pos + 1, COLON)
+        result[key], pos = parse_value(data, tokens, pos)
+        if tokens[pos][0] == COMMA:
+            pos += 1
+    return result, pos + 1
+
+
+_CONTAINERS = {LBRACE: parse_object, LBRACK: parse_array, LPAREN: parse_tuple}
+_SCALARS = {IDENT, STRING, FLOAT, INT, CONST}
+
+
+def parse_value(data, tokens, pos):
+    kind, value, start = tokens[pos]
+    if kind in _SCALARS:
+        return value, pos + 1
+    if kind in _CONTAINERS:
+        return _CONTAINERS[kind](data, tokens, pos)
+    raise _error(data, start, f'Unexpected {_KIND_NAMES[kind]}')
+
 
 def parse(text):
     """
     Attempt to parse JSON text, returning an object
     :param text: String containing json
-    :rtype: dict or list
-    :raises: parsec.ParseError
+    :rtype: dict, list or tuple
+    :raises: ParseError
     """
-    return parser.parse_strict(text)
+    data = text.encode()
+    tokens = _tokenize(data)
+    kind, _, start = tokens[0]
+    if kind not in _CONTAINERS:
+        raise _error(data, start, f'Expected object, array or tuple, got {_KIND_NAMES[kind]}')
+    result, pos = parse_value(data, tokens, 0)
+    _expect(data, tokens, pos, EOF)
+    return result
 
-__all__ = ['parse']
+__all__ = ['parse', 'ParseError']